@@ -1,77 +1,249 @@
 
 
 import asyncio
+import codecs
 import os
 import signal
 import html
 import re
 from dotenv import load_dotenv
-from telegram import Update, Document
+from telegram import Update, Document, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 # --- Globals ---
 load_dotenv()
 user_sessions = {}
+_raw_authorized_users = os.environ.get("AUTHORIZED_USERS", "").strip()
 try:
-    AUTHORIZED_USERS = {int(uid) for uid in os.environ.get("AUTHORIZED_USERS", "").split(",")}
-except (ValueError, TypeError):
-    print("Error: AUTHORIZED_USERS is not set or contains invalid user IDs. Please check your .env file.")
-    AUTHORIZED_USERS = set()
+    AUTHORIZED_USERS = frozenset(int(uid) for uid in _raw_authorized_users.split(",") if uid.strip())
+except ValueError:
+    print("Error: AUTHORIZED_USERS contains invalid user IDs. Please check your .env file.")
+    AUTHORIZED_USERS = frozenset()
+
+# Markers echoed by the shell to frame command output
+CWD_MARKER = b"---CWD_MARKER---"
+END_OF_COMMAND_MARKER = b"---EOC_MARKER---"
+
+# Matches commands that change directory, including a bare "cd"
+_CD_COMMAND_RE = re.compile(r'\s*cd(\s|$)')
+
+# Captures the main progress line from rclone -P output
+_RCLONE_PROGRESS_RE = re.compile(
+    r'Transferred:\s+(?P<transferred>\d+\.\d+\s+\w+)\s+/\s+(?P<total>\d+\.\d+\s+\w+), (?P<percent>\d+)%, (?P<speed>\d+\.\d+\s+\w+/s), ETA (?P<eta>\S+)'
+)
+
+# Every possible progress bar, indexed by percentage
+_BAR_CACHE = [f"[{'█' * round(p / 10)}{'░' * (10 - round(p / 10))}] {p}%" for p in range(101)]
+
+# The clean, overwriting /rc progress message
+_RC_PROGRESS_TEMPLATE = (
+    "<b>Transferring...</b>\n"
+    "<b>Progress:</b> {bar}\n"
+    "<b>Size:</b> <code>{transferred} / {total}</code>\n"
+    "<b>Speed:</b> <code>{speed}</code>\n"
+    "<b>ETA:</b> <code>{eta}</code>"
+)
+
+# Telegram allows roughly one edit per second per message
+MIN_EDIT_INTERVAL = 1.1
+
+# How long a command runs before its slot is checked
+COMMAND_SLOT_TIMEOUT = 600
+
+# Flush streamed output once this many bytes are pending, or after this many seconds
+FLUSH_THRESHOLD_BYTES = 3500
+FLUSH_MAX_DELAY = 2.0
+
+# Output characters per message, below Telegram's 4096 limit
+MAX_MESSAGE_CHARS = 3800
+
+# Unsent output kept per command; beyond this only the tail is posted
+MAX_PENDING_CHARS = 5 * MAX_MESSAGE_CHARS
+OUTPUT_TRUNCATED_NOTICE = "[... earlier output omitted ...]\n"
+
+# Largest document a bot may send
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+# --- Session State ---
+class Session:
+    """Per-user shell session state."""
+    __slots__ = (
+        'proc', 'cwd', 'command_running', 'slot_timeout_task',
+        'output_buffer', 'send_lock', 'stop_event', 'flush_event',
+        'decoder', 'pending_text', 'last_message_id', 'last_message_text',
+        'last_edit_ts', 'last_prompt_cwd', 'posted_since_prompt', 'stdout_task', 'stderr_task', 'flusher_task'
+    )
+
+    def __init__(self, proc: asyncio.subprocess.Process, cwd: str):
+        self.proc = proc
+        self.cwd = cwd
+        self.command_running = False
+        self.slot_timeout_task = None
+        self.output_buffer = bytearray()
+        self.send_lock = asyncio.Lock()
+        self.stop_event = asyncio.Event()
+        self.flush_event = asyncio.Event()
+        self.decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        self.pending_text = ''
+        self.last_message_id = None
+        self.last_message_text = ''
+        self.last_edit_ts = 0.0
+        self.last_prompt_cwd = None
+        self.posted_since_prompt = False
+        self.stdout_task = None
+        self.stderr_task = None
+        self.flusher_task = None
 
 # --- Helper Functions ---
-def is_authorized(user_id: int) -> bool:
-    return user_id in AUTHORIZED_USERS
+# Bound method of the frozenset, saving a Python-level call per update
+is_authorized = AUTHORIZED_USERS.__contains__
 
 async def send_and_update_prompt(update: Update, user_id: int):
     if user_id in user_sessions:
-        cwd = user_sessions[user_id]['cwd']
+        session = user_sessions[user_id]
+        cwd = session.cwd
+        # The prompt marks completion, so only skip it when it would repeat the previous one
+        if session.last_prompt_cwd == cwd and not session.posted_since_prompt:
+            return
         await update.message.reply_text(f"<code>{cwd} $</code>", parse_mode='HTML')
+        session.last_prompt_cwd = cwd
+        session.posted_since_prompt = False
 
 def create_progress_bar(percentage: int) -> str:
-    """Creates a text-based progress bar."""
-    filled_blocks = round(percentage / 10)
-    empty_blocks = 10 - filled_blocks
-    bar = "█" * filled_blocks + "░" * empty_blocks
-    return f"[{bar}] {percentage}%"
+    """Returns the precomputed text-based progress bar for a 0-100 percentage."""
+    return _BAR_CACHE[percentage]
+
+def read_file(file_path: str) -> bytes:
+    """Reads a whole file; meant to run in a worker thread."""
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+def cap_pending_text(text: str) -> str:
+    """Keeps only the tail of output too large to post in full."""
+    if len(text) <= MAX_PENDING_CHARS:
+        return text
+    return OUTPUT_TRUNCATED_NOTICE + text[-MAX_PENDING_CHARS:]
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Returns how long Telegram asked us to back off, in seconds."""
+    retry_after = error.retry_after
+    # Newer python-telegram-bot versions report a timedelta
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+async def wait_for_edit_slot(session: Session):
+    """Sleeps until MIN_EDIT_INTERVAL has passed since the session's last edit."""
+    delay = MIN_EDIT_INTERVAL - (asyncio.get_running_loop().time() - session.last_edit_ts)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+def put_latest(queue: asyncio.Queue, item):
+    """Puts an item into a single-slot queue, replacing any pending item."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
 
 # --- Core Shell Logic ---
-async def periodic_flusher(user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE, interval: int):
-    """Periodically flushes the output buffer by editing a message."""
-    while True:
+# One command at a time: the shell's single EOC marker stream cannot tell two commands apart.
+# No await separates the check from the update, so a plain flag is race-free on the event loop.
+def acquire_command_slot(session: Session, update: Update) -> bool:
+    """Claims the session's command slot, returning False if a command is running."""
+    if session.command_running:
+        return False
+    session.command_running = True
+    session.slot_timeout_task = asyncio.create_task(check_slot_after_timeout(session, update, COMMAND_SLOT_TIMEOUT))
+    return True
+
+def release_command_slot(session: Session):
+    """Frees the session's command slot and stops its timeout check."""
+    timeout_task = session.slot_timeout_task
+    if timeout_task and timeout_task is not asyncio.current_task():
+        timeout_task.cancel()
+    session.slot_timeout_task = None
+    session.command_running = False
+
+async def check_slot_after_timeout(session: Session, update: Update, timeout: float):
+    """Checks on a command whose EOC marker has not arrived within timeout."""
+    try:
+        await asyncio.sleep(timeout)
+        if session.proc.returncode is not None:
+            # The shell is gone, so no EOC marker will ever release the slot
+            release_command_slot(session)
+            await update.message.reply_text("The shell exited while a command was running. Use /start to begin a new one.")
+        else:
+            # Keep the slot: the command may still be reading stdin, and its EOC would release the next one's slot
+            minutes = round(timeout / 60)
+            await update.message.reply_text(f"The command has been running for {minutes} minutes. Use /controlC to interrupt it.")
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"Error checking command slot: {e}")
+
+async def show_output(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session, text: str, message_id=None):
+    """Shows output in an existing message, or in a new one if that fails; returns its id."""
+    sanitized_output = html.escape(text.strip())
+    if not sanitized_output:
+        return message_id
+    session.posted_since_prompt = True
+
+    if message_id:
+        try:
+            await context.bot.edit_message_text(
+                text=f"<code>{sanitized_output}</code>",
+                chat_id=update.message.chat_id,
+                message_id=message_id,
+                parse_mode='HTML'
+            )
+            return message_id
+        except BadRequest as e:
+            if "Message is not modified" in e.message:
+                return message_id
+
+    sent_message = await update.message.reply_text(f"<code>{sanitized_output}</code>", parse_mode='HTML')
+    return sent_message.message_id
+
+async def periodic_flusher(user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE, max_delay: float):
+    """Flushes the output buffer once enough output is pending or max_delay has passed."""
+    session = user_sessions[user_id]
+    while not session.stop_event.is_set():
         try:
-            await asyncio.sleep(interval)
-            if user_id not in user_sessions:
-                break
-
-            session = user_sessions[user_id]
-            async with session['buffer_lock']:
-                full_output = "".join(session['output_buffer']).strip()
-
-                if full_output and full_output != session.get('last_message_text'):
-                    sanitized_output = html.escape(full_output)
-                    if not sanitized_output:
-                        continue
-
-                    if session.get('last_message_id'):
-                        try:
-                            await context.bot.edit_message_text(
-                                text=f"<code>{sanitized_output}</code>",
-                                chat_id=update.message.chat_id,
-                                message_id=session['last_message_id'],
-                                parse_mode='HTML'
-                            )
-                            session['last_message_text'] = full_output
-                        except BadRequest as e:
-                            if "Message is not modified" not in e.message:
-                                session['last_message_id'] = None
-                    
-                    if not session.get('last_message_id'):
-                        sent_message = await update.message.reply_text(f"<code>{sanitized_output}</code>", parse_mode='HTML')
-                        session['last_message_id'] = sent_message.message_id
-                        session['last_message_text'] = full_output
+            try:
+                await asyncio.wait_for(session.flush_event.wait(), timeout=max_delay)
+            except asyncio.TimeoutError:
+                pass
+            session.flush_event.clear()
+
+            await wait_for_edit_slot(session)
+
+            # Held across the sends so the EOC path cannot post the same output concurrently
+            async with session.send_lock:
+                # Detach and decode the bytes that arrived since the last flush, with no await in between
+                if session.output_buffer:
+                    buffer = session.output_buffer
+                    session.output_buffer = bytearray()
+                    session.pending_text = cap_pending_text(session.pending_text + session.decoder.decode(buffer))
+                text = session.last_message_text + session.pending_text
+                if not session.pending_text or not text.strip():
+                    continue
+
+                # The state follows each piece, so a failed send never re-posts earlier ones
+                if len(text) > MAX_MESSAGE_CHARS:
+                    # Fill up and leave behind the live message; the rest waits for the next tick
+                    await show_output(update, context, session, text[:MAX_MESSAGE_CHARS], session.last_message_id)
+                    session.last_message_id = None
+                    session.last_message_text = ''
+                    session.pending_text = text[MAX_MESSAGE_CHARS:]
+                    session.flush_event.set()
+                else:
+                    session.last_message_id = await show_output(update, context, session, text, session.last_message_id)
+                    session.last_message_text = text
+                    session.pending_text = ''
+                session.last_edit_ts = asyncio.get_running_loop().time()
         except asyncio.CancelledError:
             break
+        except RetryAfter as e:
+            # Back off as asked; unsent output stays pending for the next tick
+            session.last_edit_ts = asyncio.get_running_loop().time() + retry_after_seconds(e)
         except Exception as e:
             print(f"Error in periodic flusher for user {user_id}: {e}")
 
@@ -82,81 +254,103 @@ async def start_shell_session(user_id: int, update: Update, context: ContextType
         stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
         preexec_fn=os.setsid
     )
-    user_sessions[user_id] = {
-        'proc': proc, 'cwd': os.path.expanduser("~"),
-        'lock': asyncio.Lock(), 'output_buffer': [],
-        'buffer_lock': asyncio.Lock(), 'last_message_id': None,
-        'last_message_text': ''
-    }
-    session = user_sessions[user_id]
-    session['stdout_task'] = asyncio.create_task(read_stream(proc.stdout, user_id, update, context, "stdout"))
-    session['stderr_task'] = asyncio.create_task(read_stream(proc.stderr, user_id, update, context, "stderr"))
-    session['flusher_task'] = asyncio.create_task(periodic_flusher(user_id, update, context, 30))
-
-    initial_cd_command = f"cd {os.path.expanduser('~')}\n"
+    session = user_sessions[user_id] = Session(proc, os.path.expanduser("~"))
+    session.stdout_task = asyncio.create_task(read_stream(proc.stdout, user_id, update, context, "stdout"))
+    session.stderr_task = asyncio.create_task(read_stream(proc.stderr, user_id, update, context, "stderr"))
+    session.flusher_task = asyncio.create_task(periodic_flusher(user_id, update, context, FLUSH_MAX_DELAY))
+
+    # bash -i writes PS1 to stderr after every command, which would be posted as a stray message.
+    # Cleared here rather than in the environment, since .bashrc sets it again at startup.
+    initial_cd_command = f"PS1= PS2= ; cd {os.path.expanduser('~')}\n"
     proc.stdin.write(initial_cd_command.encode())
     await proc.stdin.drain()
     await send_and_update_prompt(update, user_id)
 
-async def read_stream(stream, user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE, stream_name: str):
-    """Continuously reads from a stream, handles markers, and buffers output."""
-    CWD_MARKER = "---CWD_MARKER---"
-    END_OF_COMMAND_MARKER = "---EOC_MARKER---"
+async def send_final_output(update: Update, context: ContextTypes.DEFAULT_TYPE, session: Session, text: str, last_message_id, last_message_text: str):
+    """Sends the rest of a finished command's output, continuing the streamed message if there is one."""
+    if text == last_message_text:
+        return
+    while True:
+        piece, text = text[:MAX_MESSAGE_CHARS], text[MAX_MESSAGE_CHARS:]
+        # Pace the pieces like streamed edits, retrying a piece Telegram rejected for flooding
+        await wait_for_edit_slot(session)
+        try:
+            await show_output(update, context, session, piece, last_message_id)
+        except RetryAfter as e:
+            session.last_edit_ts = asyncio.get_running_loop().time() + retry_after_seconds(e)
+            text = piece + text
+            continue
+        session.last_edit_ts = asyncio.get_running_loop().time()
+        if not text:
+            break
+        last_message_id = None
 
+async def send_prompt_with_backoff(update: Update, user_id: int, session: Session):
+    """Sends the prompt, retrying after the delay Telegram asks for when flooded."""
     while True:
         try:
-            if user_id not in user_sessions: break
-            session = user_sessions[user_id]
+            await send_and_update_prompt(update, user_id)
+            return
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            session.last_edit_ts = asyncio.get_running_loop().time() + delay
+            await asyncio.sleep(delay)
 
-            chunk = await stream.read(4096)
+async def read_stream(stream, user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE, stream_name: str):
+    """Continuously reads from a stream, handles markers, and buffers output."""
+    session = user_sessions[user_id]
+    while not session.stop_event.is_set():
+        try:
+            chunk = await stream.read(65536)
             if not chunk: break
 
-            output = chunk.decode(errors='ignore')
-
-            if END_OF_COMMAND_MARKER in output:
-                pre_marker_output, _, _ = output.partition(END_OF_COMMAND_MARKER)
-                async with session['buffer_lock']:
-                    if pre_marker_output:
-                        session['output_buffer'].append(pre_marker_output)
-                    
-                    full_output = "".join(session['output_buffer']).strip()
-                    sanitized_output = html.escape(full_output.replace(CWD_MARKER, ""))
-
-                    if session.get('last_message_id') and sanitized_output and sanitized_output != session.get('last_message_text'):
-                        try:
-                            await context.bot.edit_message_text(
-                                text=f"<code>{sanitized_output}</code>",
-                                chat_id=update.message.chat_id,
-                                message_id=session['last_message_id'],
-                                parse_mode='HTML'
-                            )
-                        except BadRequest as e:
-                            if "Message is not modified" not in e.message:
-                                await update.message.reply_text(f"<code>{sanitized_output}</code>", parse_mode='HTML')
-                    elif not session.get('last_message_id') and sanitized_output:
-                         await update.message.reply_text(f"<code>{sanitized_output}</code>", parse_mode='HTML')
-
-                    session['output_buffer'].clear()
-                    session['last_message_id'] = None
-                    session['last_message_text'] = ''
-
-                if session['lock'].locked():
-                    session['lock'].release()
-                await send_and_update_prompt(update, user_id)
-            else:
-                output_to_buffer = output
-                if CWD_MARKER in output:
-                    try:
-                        parts = output.split(CWD_MARKER)
-                        new_cwd = parts[1].strip().split('\n')[0]
-                        if new_cwd:
-                            session['cwd'] = new_cwd
-                        output_to_buffer = parts[0] + (parts[2] if len(parts) > 2 else "")
-                    except (IndexError, KeyError):
-                        output_to_buffer = output
-                if output_to_buffer:
-                    async with session['buffer_lock']:
-                        session['output_buffer'].append(output_to_buffer)
+            if CWD_MARKER in chunk:
+                parts = chunk.split(CWD_MARKER)
+                if len(parts) > 2:
+                    new_cwd = parts[1].strip().split(b'\n')[0].decode(errors='ignore')
+                    if new_cwd:
+                        session.cwd = new_cwd
+                chunk = parts[0] + b"".join(parts[2:])
+
+            eoc_index = chunk.find(END_OF_COMMAND_MARKER)
+            if eoc_index != -1:
+                # Append the pre-marker bytes without copying them into a new object
+                session.output_buffer += memoryview(chunk)[:eoc_index]
+
+                # Wait for an in-flight flush, so its message state is final before it is read
+                async with session.send_lock:
+                    # Swap in a fresh buffer; no await happens until the old one is detached
+                    raw_output = session.output_buffer
+                    session.output_buffer = bytearray()
+
+                    last_message_id = session.last_message_id
+                    last_message_text = session.last_message_text
+                    # final=True also resets the decoder for the next command
+                    final_text = last_message_text + cap_pending_text(session.pending_text + session.decoder.decode(raw_output, final=True))
+                    session.pending_text = ''
+                    session.last_message_id = None
+                    session.last_message_text = ''
+
+                    release_command_slot(session)
+
+                # The output is detached, so the flusher need not wait on these sends
+                try:
+                    if last_message_id and len(final_text) <= MAX_MESSAGE_CHARS:
+                        # Editing an earlier message cannot reorder it after the prompt
+                        await asyncio.gather(
+                            send_final_output(update, context, session, final_text, last_message_id, last_message_text),
+                            send_prompt_with_backoff(update, user_id, session)
+                        )
+                    else:
+                        await send_final_output(update, context, session, final_text, last_message_id, last_message_text)
+                        await send_prompt_with_backoff(update, user_id, session)
+                except Exception as e:
+                    # A failed send must not stop this reader, or no later command would finish
+                    print(f"Error sending final output for user {user_id}: {e}")
+            elif chunk:
+                session.output_buffer += chunk
+                if len(session.output_buffer) > FLUSH_THRESHOLD_BYTES:
+                    session.flush_event.set()
         except asyncio.CancelledError:
             break
         except Exception as e:
@@ -164,6 +358,63 @@ async def read_stream(stream, user_id: int, update: Update, context: ContextType
             break
 
 # --- Rclone Progress Bar Logic ---
+async def consume_lines(stream, on_line):
+    """Passes each line of a stream to a callback until EOF."""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # Line exceeded the stream limit and was discarded; keep draining
+            continue
+        if not line:
+            break
+        on_line(line)
+
+async def progress_editor(queue: asyncio.Queue, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int):
+    """Edits the progress message with the latest queued text, at most once per MIN_EDIT_INTERVAL.
+
+    Returns the loop time of the last edit once cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    last_update_text = ""
+    last_edit_ts = 0.0
+    while True:
+        try:
+            text = await queue.get()
+            delay = MIN_EDIT_INTERVAL - (loop.time() - last_edit_ts)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                # Newer progress may have arrived while waiting
+                if not queue.empty():
+                    text = queue.get_nowait()
+
+            # Edit the message only if the text has changed
+            if text == last_update_text:
+                continue
+            try:
+                await context.bot.edit_message_text(
+                    text=text,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode='HTML'
+                )
+                last_update_text = text
+                last_edit_ts = loop.time()
+            except BadRequest as e:
+                # Ignore "message is not modified" errors, print others
+                if "Message is not modified" not in e.message:
+                    print(f"Error updating message: {e}")
+            except RetryAfter as e:
+                # Back off as asked and retry this text unless newer progress arrives first
+                last_edit_ts = loop.time() + retry_after_seconds(e)
+                if queue.empty():
+                    queue.put_nowait(text)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"Error in progress editor: {e}")
+    return last_edit_ts
+
 async def rc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     if not is_authorized(user_id):
@@ -181,81 +432,60 @@ async def rc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if command_args[0] == 'rclone' and '-P' not in command_args and '--progress' not in command_args:
         command_args.append('-P')
     
+    # Only used for display; the arguments are passed to the process as-is
     full_command = " ".join(command_args)
 
     sent_message = await update.message.reply_text(f"Starting: <code>{full_command}</code>", parse_mode='HTML')
     message_id = sent_message.message_id
 
-    proc = await asyncio.create_subprocess_shell(
-        full_command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *command_args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+    except OSError as e:
+        await context.bot.edit_message_text(
+            text=f"Failed to start <code>{html.escape(command_args[0])}</code>: {html.escape(str(e))}",
+            chat_id=update.message.chat_id,
+            message_id=message_id,
+            parse_mode='HTML'
+        )
+        return
 
-    last_update_text = ""
+    edit_queue = asyncio.Queue(maxsize=1)
+    editor_task = asyncio.create_task(progress_editor(edit_queue, context, update.message.chat_id, message_id))
     
-    # Main loop to read output and update message
-    while True:
-        try:
-            # Wait for a new line of output for up to 5 seconds
-            line = await asyncio.wait_for(proc.stderr.readline(), timeout=5.0)
-            if not line:
-                # If stream ends, break the loop
-                break
-            
-            output = line.decode().strip()
-            
-            # Regex to capture the main progress line from rclone
-            match = re.search(
-                r'Transferred:\s+(?P<transferred>\d+\.\d+\s+\w+)\s+/\s+(?P<total>\d+\.\d+\s+\w+), (?P<percent>\d+)%, (?P<speed>\d+\.\d+\s+\w+/s), ETA (?P<eta>\S+)',
-                output
-            )
-            
-            if match:
-                data = match.groupdict()
-                percentage = int(data['percent'])
-                progress_bar = create_progress_bar(percentage)
-                
-                # Construct the clean, overwriting message
-                text = (
-                    f"<b>Transferring...</b>\n"
-                    f"<b>Progress:</b> {progress_bar}\n"
-                    f"<b>Size:</b> <code>{data['transferred']} / {data['total']}</code>\n"
-                    f"<b>Speed:</b> <code>{data['speed']}</code>\n"
-                    f"<b>ETA:</b> <code>{data['eta']}</code>"
-                )
-
-                # Edit the message only if the text has changed
-                if text != last_update_text:
-                    try:
-                        await context.bot.edit_message_text(
-                            text=text,
-                            chat_id=update.message.chat_id,
-                            message_id=message_id,
-                            parse_mode='HTML'
-                        )
-                        last_update_text = text
-                    except BadRequest as e:
-                        # Ignore "message is not modified" errors, print others
-                        if "Message is not modified" not in e.message:
-                            print(f"Error updating message: {e}")
-            # We simply ignore lines that aren't progress lines
-
-        except asyncio.TimeoutError:
-            # This is expected. If 5 seconds pass with no new output, we just continue.
-            pass
-        except Exception as e:
-            print(f"Error in rc_command loop: {e}")
-            break # Exit loop on other errors
-        
-        # Check if the process has finished after attempting to read a line or after a timeout
-        if proc.returncode is not None:
-            break
-
-    # Wait for the process to fully finish and collect final output
-    await proc.wait()
-    stdout, stderr = await proc.communicate()
-    final_output = (stdout.decode() + stderr.decode()).strip()
+    stdout_lines = []
+    error_lines = []
+
+    def on_stderr_line(line: bytes):
+        output = line.decode(errors='ignore').strip()
+        match = _RCLONE_PROGRESS_RE.search(output)
+        if match:
+            data = match.groupdict()
+            percentage = max(0, min(100, int(data['percent'])))
+            data['bar'] = create_progress_bar(percentage)
+            put_latest(edit_queue, _RC_PROGRESS_TEMPLATE.format_map(data))
+        elif "ERROR" in output:
+            # Keep errors for the final message; other stats lines are redrawn progress
+            error_lines.append(output)
+
+    # Read both streams concurrently until the process exits
+    stderr_task = asyncio.create_task(consume_lines(proc.stderr, on_stderr_line))
+    stdout_task = asyncio.create_task(consume_lines(proc.stdout, stdout_lines.append))
+    # Process exit and EOF on both pipes end the transfer; nothing is polled
+    results = await asyncio.gather(proc.wait(), stderr_task, stdout_task, return_exceptions=True)
+    for result in results[1:]:
+        if isinstance(result, Exception):
+            print(f"Error reading rclone output: {result}")
+    # Let an in-flight progress edit finish so it cannot overwrite the final message
+    editor_task.cancel()
+    editor_result, = await asyncio.gather(editor_task, return_exceptions=True)
+    # The editor has no timestamp if it was cancelled before it started
+    last_edit_ts = editor_result if isinstance(editor_result, float) else 0.0
+
+    final_output = (b"".join(stdout_lines).decode(errors='ignore') + "\n".join(error_lines)).strip()
 
     # Final message after completion
     final_text = f"<b>Transfer complete!</b>\n\n<code>{full_command}</code>"
@@ -263,16 +493,25 @@ async def rc_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Add any final, non-progress output (like errors or summary)
         final_text += f"\n\n<b>Final Output:</b>\n<code>{html.escape(final_output)}</code>"
 
-    try:
-        await context.bot.edit_message_text(
-            text=final_text,
-            chat_id=update.message.chat_id,
-            message_id=message_id,
-            parse_mode='HTML'
-        )
-    except BadRequest:
-        # If editing fails (e.g., message deleted), send a new one
-        await update.message.reply_text(final_text, parse_mode='HTML')
+    # Keep the completion edit within the rate limit so a 429 cannot drop it
+    delay = MIN_EDIT_INTERVAL - (asyncio.get_running_loop().time() - last_edit_ts)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    while True:
+        try:
+            await context.bot.edit_message_text(
+                text=final_text,
+                chat_id=update.message.chat_id,
+                message_id=message_id,
+                parse_mode='HTML'
+            )
+            break
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+        except BadRequest:
+            # If editing fails (e.g., message deleted), send a new one
+            await update.message.reply_text(final_text, parse_mode='HTML')
+            break
 
 # --- Command Handlers ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -280,9 +519,12 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_authorized(user_id):
         await update.message.reply_text("You are not authorized.")
         return
-    if user_id in user_sessions and user_sessions[user_id]['proc'].returncode is None:
+    if user_id in user_sessions and user_sessions[user_id].proc.returncode is None:
         await update.message.reply_text("An interactive shell is already running.")
     else:
+        if user_id in user_sessions:
+            # Stop the tasks still bound to the exited shell's session
+            user_sessions[user_id].stop_event.set()
         await update.message.reply_text("Starting interactive shell...\nType commands directly. Use /type for interactive prompts, /download, /end, or /controlC.")
         await start_shell_session(user_id, update, context)
 
@@ -293,11 +535,12 @@ async def end_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     session = user_sessions[user_id]
-    for task_name in ['stdout_task', 'stderr_task', 'flusher_task']:
-        if task_name in session and session[task_name]:
-            session[task_name].cancel()
+    session.stop_event.set()
+    for task in [session.stdout_task, session.stderr_task, session.flusher_task, session.slot_timeout_task]:
+        if task:
+            task.cancel()
 
-    proc = session['proc']
+    proc = session.proc
     proc.terminate()
     await proc.wait()
     del user_sessions[user_id]
@@ -310,10 +553,10 @@ async def control_c_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     session = user_sessions[user_id]
     try:
-        os.killpg(os.getpgid(session['proc'].pid), signal.SIGINT)
+        os.killpg(os.getpgid(session.proc.pid), signal.SIGINT)
         await update.message.reply_text("Interrupt signal (Ctrl+C) sent.")
-        if session['lock'].locked():
-            session['lock'].release()
+        session.posted_since_prompt = True
+        release_command_slot(session)
         await send_and_update_prompt(update, user_id)
     except ProcessLookupError:
         await update.message.reply_text("Process seems to have already ended.")
@@ -330,8 +573,8 @@ async def type_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     session = user_sessions[user_id]
     input_text = " ".join(context.args) + "\n"
-    session['proc'].stdin.write(input_text.encode())
-    await session['proc'].stdin.drain()
+    session.proc.stdin.write(input_text.encode())
+    await session.proc.stdin.drain()
     await update.message.reply_text(f"Typed: {input_text.strip()}")
 
 async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -343,18 +586,21 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     session = user_sessions[user_id]
-    if session['lock'].locked():
+    if not acquire_command_slot(session, update):
         await update.message.reply_text("A command is already running. Please wait or use /controlC.")
         return
 
-    await session['lock'].acquire()
     command = update.message.text
-    if command.strip().startswith('cd '):
-        full_command = f"{command} && echo ---CWD_MARKER--- && pwd && echo ---CWD_MARKER--- && echo ---EOC_MARKER---\n"
+    # printf and $PWD are shell builtins, so the markers cost no extra processes.
+    # The markers are assembled by printf so the shell's echo of this line never contains them.
+    if _CD_COMMAND_RE.match(command):
+        full_command = f"{command} ; printf -- '---CWD_%s---%s---CWD_%s---' MARKER \"$PWD\" MARKER ; printf -- '---EOC_%s---\\n' MARKER\n"
     else:
-        full_command = f"{command} ; echo ---EOC_MARKER---\n"
-    session['proc'].stdin.write(full_command.encode())
-    await session['proc'].stdin.drain()
+        full_command = f"{command} ; printf -- '---EOC_%s---\\n' MARKER\n"
+    # The user's command is itself a new chat message, so the prompt must follow it
+    session.posted_since_prompt = True
+    session.proc.stdin.write(full_command.encode())
+    await session.proc.stdin.drain()
 
 async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -365,9 +611,14 @@ async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /download <file_path>")
         return
     session = user_sessions[user_id]
-    file_path = os.path.join(session['cwd'], context.args[0])
+    file_path = os.path.join(session.cwd, context.args[0])
     try:
-        await update.message.reply_document(document=open(file_path, 'rb'))
+        # InputFile reads file objects in full on the event loop, so read in a thread instead
+        if await asyncio.to_thread(os.path.getsize, file_path) > MAX_UPLOAD_BYTES:
+            await update.message.reply_text("File is too large to send (the limit is 50 MB).")
+            return
+        content = await asyncio.to_thread(read_file, file_path)
+        await update.message.reply_document(document=InputFile(content, filename=os.path.basename(file_path)))
     except FileNotFoundError:
         await update.message.reply_text("File not found.")
     except Exception as e:
@@ -381,11 +632,11 @@ async def upload_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session = user_sessions[user_id]
     doc = update.message.document
     file_name = doc.file_name
-    file_path = os.path.join(session['cwd'], file_name)
+    file_path = os.path.join(session.cwd, file_name)
     try:
         file = await doc.get_file()
         await file.download_to_drive(file_path)
-        await update.message.reply_text(f"File '{file_name}' uploaded successfully to {session['cwd']}.")
+        await update.message.reply_text(f"File '{file_name}' uploaded successfully to {session.cwd}.")
     except Exception as e:
         await update.message.reply_text(f"Failed to upload file: {e}")
 